@@ -1,14 +1,97 @@
 from __future__ import print_function
 
 import numpy as np
-from libs.turbulence import VelocityGrid
+from sys import exit
+from os import path
+from shutil import copyfile
+from libs.turbulence import VelocityGrid, NestedGrid, normalize_turbulence
 from libs.uniform_sphere import Sphere
+from libs.geometry import Ellipsoid, Cylinder, PeriodicBox, pair_energy
 from libs.rotation import Rotation
 from libs.const import G, msol, parsec
-from libs.utils import save_particles
+from libs.utils import save_particles, check_outfile
+from libs.readers import open_snapshot
+from libs.diagnostics import report
 from libs.options_parser import OptionsParser
 
 
+def reseed(args, dtype):
+    """ Replaces the gas velocities of an existing snapshot by a turbulent
+        field (plus rotation), normalised with alpha and beta. The input
+        is copied to the output file, which is then modified in place one
+        chunk of particles at a time. If both are the same file, it is
+        modified directly.
+    """
+    if path.isfile(args.outfile) and path.samefile(args.infile, args.outfile):
+        print("Input and output are the same file, modifying it in place.")
+    else:
+        check_outfile(args.outfile)
+        copyfile(args.infile, args.outfile)
+
+    snap  = open_snapshot(args.outfile, mode='r+')
+    pos   = snap.positions(0)
+    vel   = snap.velocities(0)
+    mass  = snap.masses(0)
+    ngas  = len(mass)
+    chunk = args.chunk
+    print("Read {:d} gas cells from {}".format(ngas, args.infile))
+
+    # gravitational constant in the units of the file
+    grav = G * msol / parsec / 1.e10 if args.units else G
+
+    # bounding box and center of mass of the gas
+    lo   = np.full(3,  np.inf)
+    hi   = np.full(3, -np.inf)
+    mtot = 0.
+    r_cm = np.zeros(3)
+    for i in range(0, ngas, chunk):
+        p     = np.asarray(pos[i:i+chunk])
+        m     = np.asarray(mass[i:i+chunk], dtype=np.float64)
+        lo    = np.minimum(lo, p.min(axis=0))
+        hi    = np.maximum(hi, p.max(axis=0))
+        mtot += m.sum()
+        r_cm += (m[:,None] * p).sum(axis=0)
+    r_cm /= mtot
+    side = (hi - lo).max()
+    dx   = 0.5 * (4 * side**3 / ngas)**(1./3)
+
+    # non-periodic grid around the bounding cube of the gas, padded to
+    # twice its size as the gas may fill its faces, so opposite sides of
+    # the cloud are not correlated. Particles are shifted by lo
+    vg = VelocityGrid(xmax=side, dx=2*dx, npow=args.npow, ngrid=args.ngrid,
+                      dtype=dtype)
+    vg.coordinate_grid(xstart=-0.5*side, xend=1.5*side)
+
+    grid = vg
+    if args.levels > 0:
+        # refined grids, each refine times smaller, around the center
+        # of mass
+        grid  = NestedGrid(vg)
+        lside = side
+        for level in range(args.levels):
+            lside /= args.refine
+            grid.add_level(center=r_cm-lo, side=lside)
+
+    print("Adding turbulent velocity to particles.")
+    for i in range(0, ngas, chunk):
+        p = np.asarray(pos[i:i+chunk]) - lo
+        vel[i:i+chunk] = grid.add_turbulence(pos=p, vel=np.zeros_like(p))
+
+    # gravitational energy estimated from a subsample of the particles
+    nsub = min(ngas, 10**6)
+    idx  = np.sort(np.random.default_rng(0).choice(ngas, nsub, replace=False))
+    epot = pair_energy(pos[idx], mass[idx]) * grav / G * \
+           ngas * (ngas - 1.) / (nsub * (nsub - 1.))
+
+    vel  = normalize_turbulence(vel, mass, alpha=args.alpha, epot=epot,
+                                chunk=chunk)
+
+    rot = Rotation(beta=args.beta, alpha=args.alpha, epot=epot)
+    vel = rot.add_rotation(pos=pos, vel=vel, mass=mass, chunk=chunk)
+
+    snap.close()
+
+
 if __name__ == "__main__":
 
     op     = OptionsParser()
@@ -17,6 +100,25 @@ if __name__ == "__main__":
     mcloud = args.mass * msol
     rcloud = args.radius * parsec
     n      = args.num
+    dtype  = np.float32 if args.single else np.float64
+
+    if args.infile is not None:
+        print("Adding turbulence to the gas in {}".format(args.infile))
+        # the cloud is read from the file, so these options do not apply
+        ignored = [opt for opt, dest in [("-n", "num"), ("-mass", "mass"),
+                   ("-radius", "radius"), ("-gamma", "gamma"),
+                   ("-geometry", "geometry"), ("-axes", "axes"),
+                   ("-length", "length"), ("-tile", "tile"),
+                   ("-sink", "sink"), ("-format", "format"),
+                   ("--longids", "longids"), ("--diagnostics", "diagnostics")]
+                   if getattr(args, dest) != op.parser.get_default(dest)]
+        if len(ignored) > 0:
+            print("WARNING: Options {} are not used with an input file.".\
+                   format(", ".join(ignored)))
+        reseed(args, dtype)
+        print("done...bye!")
+        exit()
+
     print("We want {:d} gas cells to represent the cloud".format(n))
 
     # where we want to place the cloud's center of mass
@@ -24,8 +126,24 @@ if __name__ == "__main__":
 
     # first, determine position of particles given total number of
     # desired cells
-    cloud = Sphere(n=n, center=r_com, radius=rcloud, mass=mcloud)
-    cloud.add_profile(gamma=args.gamma)
+    if args.geometry == "sphere":
+        cloud = Sphere(n=n, center=r_com, radius=rcloud, mass=mcloud,
+                       dtype=dtype)
+        cloud.add_profile(gamma=args.gamma)
+        extent = rcloud
+    else:
+        if args.geometry == "ellipsoid":
+            cloud = Ellipsoid(n=n, center=r_com, axes=rcloud*np.array(args.axes),
+                              mass=mcloud, dtype=dtype)
+        elif args.geometry == "cylinder":
+            cloud = Cylinder(n=n, center=r_com, radius=rcloud,
+                             length=args.length*parsec, mass=mcloud, dtype=dtype)
+        elif args.geometry == "box":
+            cloud = PeriodicBox(n=n, center=r_com, side=2*rcloud, mass=mcloud,
+                                dtype=dtype)
+        if args.gamma != 0:
+            print("WARNING: Density profiles are only available for spheres.")
+        extent = cloud.extent.max()
 
     pos   = cloud.pos
     dx    = cloud.dx
@@ -33,30 +151,73 @@ if __name__ == "__main__":
     mass  = cloud.mass
 
     ids   = np.arange(1, ngas+1)
-    u     = np.zeros(ngas)
-    vel   = np.zeros((ngas, 3))
+    u     = np.zeros(ngas, dtype=dtype)
+    vel   = np.zeros((ngas, 3), dtype=dtype)
+
+    # the grid covers the cloud's bounding cube, or a tile of it that
+    # is repeated periodically. Isolated clouds get a non-periodic grid,
+    # padded to twice the cube if they fill its faces (the field is
+    # still periodic over the grid), so opposite sides are not correlated
+    ngrid    = args.ngrid
+    xgrid    = 2*extent / args.tile
+    periodic = args.geometry == "box" or args.tile > 1
+    pad      = 1 if periodic or args.geometry == "sphere" else 2
+    xstart   = r_com[0] - extent - 0.5*(pad-1)*xgrid
+    if args.geometry == "box" and args.tile == 1 and ngrid % cloud.nside != 0:
+        # smallest multiple of the lattice not below the requested ngrid
+        ngrid = -(-ngrid // cloud.nside) * cloud.nside
+        print("Using ngrid = {:d} (a multiple of the {:d} lattice nodes per "
+              "side) instead of {:d}.".format(ngrid, cloud.nside, args.ngrid))
 
     # produce the velocity grid for turbulent ICs
-    vg = VelocityGrid(xmax=2*rcloud, dx=dx, npow=args.npow, ngrid=args.ngrid)
-    vg.coordinate_grid(xstart=r_com[0]-rcloud, xend=r_com[0]+rcloud)
+    vg = VelocityGrid(xmax=xgrid, dx=dx*pad, npow=args.npow, ngrid=ngrid,
+                      dtype=dtype)
+    vg.coordinate_grid(xstart=xstart, xend=xstart+pad*xgrid,
+                       periodic=periodic)
     print("Adding turbulent velocity to particles.")
-    vel = vg.add_turbulence(pos=pos, vel=vel)
+    if args.geometry == "box" and args.tile == 1:
+        # particles sit on the grid nodes, no interpolation needed
+        if args.levels > 0:
+            print("WARNING: Refined grids are not used in a periodic box.")
+        vel += vg.node_velocities(stride=ngrid // cloud.nside)
+    elif args.levels > 0 and args.tile == 1:
+        # refined grids, each refine times smaller, around the center
+        ng   = NestedGrid(vg)
+        side = (vg.x[-1] - vg.x[0]) / pad
+        for level in range(args.levels):
+            side /= args.refine
+            ng.add_level(center=r_com, side=side)
+        vel = ng.add_turbulence(pos=pos, vel=vel)
+    else:
+        if args.levels > 0:
+            print("WARNING: Refined grids are not used with -tile.")
+        vel = vg.add_turbulence(pos=pos, vel=vel)
 
     # now we need to normalize the velocity values
     # we do it according to the alpha value
-    vtur = vel - np.mean(vel, axis=0)
-    vt2  = np.linalg.norm(vtur, axis=1)**2
-    etur = 0.5 * np.sum(mass * vt2)
-    epot = 3./5. * G * np.sum(mass)**2 / rcloud
-    kvel = np.sqrt(args.alpha * epot / etur)
-    vel *= kvel
+    if args.geometry == "sphere":
+        epot = 3./5. * G * np.sum(mass, dtype=np.float64)**2 / rcloud
+    else:
+        epot = cloud.potential_energy()
+    vel  = normalize_turbulence(vel, mass, alpha=args.alpha, epot=epot)
 
     # we manually add rotation if desired
     rot = Rotation(beta=args.beta, alpha=args.alpha, epot=epot)
     vel = rot.add_rotation(pos=pos, vel=vel, mass=mass)
 
 
+    if args.diagnostics:
+        report(vg, pos, vel, mass, epot)
+
+    # optional sink particle (type 5) at the cloud's center
+    components = None
+    if args.sink > 0:
+        print("Adding a sink particle of {:g} Msol.".format(args.sink))
+        components = {5: (np.array([ngas+1]), np.array([r_com]),
+                          np.zeros((1, 3)), np.array([args.sink * msol]))}
+
     print("Writing output file {}...".format(args.outfile))
-    save_particles(ids, pos, vel, mass, u, args.outfile, args.format, args.units)
+    save_particles(ids, pos, vel, mass, u, args.outfile, args.format, args.units,
+                   components=components, long_ids=args.longids or None)
 
     print("done...bye!")
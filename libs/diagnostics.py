@@ -0,0 +1,213 @@
+from __future__ import print_function
+
+from numpy import sqrt, log, exp, abs, arange, zeros, ones, full, ceil
+from numpy import bincount, digitize, linspace, polyfit, newaxis, float64
+from numpy import fft, random, median, isfinite
+from numpy.linalg import norm
+from time import time
+from scipy.fft import rfftn
+from scipy.spatial import cKDTree
+
+
+def spectral_sums(vg, nslab=16):
+    """ Function for measuring, in one pass over Fourier space, the
+        shell-averaged power spectrum and the divergence/curl ratio of a
+        velocity grid. Only one component transform and one accumulator
+        of k.v are kept in memory, and the binning is done in slabs of
+        nslab planes with bincount.
+
+        Arguments:
+            vg   : VelocityGrid (or any object with vx, vy, vz cubes)
+            nslab: number of kx planes binned at a time
+
+        Returns:
+            k    : wavenumber of each shell, in units of the fundamental
+                   mode of the grid
+            pk   : power per mode in each shell, normalized such that
+                   summing it over all modes gives <v^2>
+            ratio: |div v|^2 / |curl v|^2 summed over all modes
+    """
+    ngrid = vg.vx.shape[0]
+    kx    = fft.fftfreq(ngrid, d=1./ngrid)
+    kz    = fft.rfftfreq(ngrid, d=1./ngrid)
+    nbins = int(ceil(sqrt(3.)*ngrid/2.)) + 2
+
+    # modes with 0 < kz < ngrid/2 stand for their conjugate pair as well
+    wz     = full(kz.shape, 2.)
+    wz[0]  = 1.
+    wz[-1] = 1.
+
+    power  = zeros(nbins)
+    modes  = zeros(nbins)
+    k2v2   = 0.
+    div    = None
+
+    for c, v in enumerate((vg.vx, vg.vy, vg.vz)):
+        vk = rfftn(v, norm="forward", workers=-1)
+        if div is None:
+            div = zeros(vk.shape, dtype=vk.dtype)
+
+        for i in range(0, ngrid, nslab):
+            sl   = slice(i, i+nslab)
+            kk   = kx[sl,newaxis,newaxis]**2 + kx[newaxis,:,newaxis]**2 +\
+                   kz[newaxis,newaxis,:]**2
+            w    = wz * ones(kk.shape)
+            p    = w * abs(vk[sl])**2
+            kbin = (sqrt(kk) + 0.5).astype(int).ravel()
+
+            power += bincount(kbin, weights=p.ravel(), minlength=nbins)
+            k2v2  += (kk * p).sum()
+            if c == 0:
+                modes += bincount(kbin, weights=w.ravel(), minlength=nbins)
+
+            kc = (kx[sl,newaxis,newaxis], kx[newaxis,:,newaxis],
+                  kz[newaxis,newaxis,:])[c]
+            div[sl] += kc * vk[sl]
+        del vk
+
+    # |k x v|^2 = k^2 |v|^2 - |k . v|^2
+    div2 = 0.
+    for i in range(0, ngrid, nslab):
+        div2 += (wz * abs(div[i:i+nslab])**2).sum()
+    del div
+
+    good  = modes > 0
+    k     = arange(nbins)[good]
+    pk    = power[good] / modes[good]
+    ratio = div2 / (k2v2 - div2)
+
+    return k, pk, ratio
+
+
+def spectral_index(k, pk, kfit=None):
+    """ Function for fitting the power index of a power spectrum, i.e.
+        P_k~k**npow, within the range kfit = (kmin, kmax).
+        By default it uses k_Nyquist/8 <= k <= k_Nyquist/2, away from the
+        outer scale (where the spectrum flattens) and from the grid scale.
+    """
+    if kfit is None:
+        knyq = k.max() / sqrt(3.)
+        kfit = (max(2., knyq/8.), knyq/2.)
+
+    fit = (k >= kfit[0]) & (k <= kfit[1]) & (pk > 0)
+    npow, _ = polyfit(log(k[fit]), log(pk[fit]), 1)
+
+    return npow
+
+
+def structure_functions(pos, vel, orders=(1, 2, 3), nbins=20, npairs=10**6,
+                        lmin=None, lmax=None, chunk=10**5, seed=0):
+    """ Function for measuring the velocity structure functions
+        S_p(l) = <|v(x+l) - v(x)|^p> at the particles positions.
+        Pairs are drawn by picking a random particle and the particle
+        nearest to a point at a log-uniform random distance from it, so
+        that all scales are equally sampled. Pairs are processed in chunks.
+
+        Arguments:
+            pos, vel: particles positions and velocities
+            orders  : orders p of the structure functions
+            nbins   : number of logarithmic separation bins
+            npairs  : total number of sampled pairs
+            lmin    : smallest separation (default twice the median
+                      distance to the nearest neighbour)
+            lmax    : largest separation (default half the extent)
+            chunk   : number of pairs processed at a time
+            seed    : seed of the random pairs
+
+        Returns:
+            l : separation at the center of each bin
+            sf: array of shape (len(orders), nbins) with S_p(l)
+            n : number of pairs per bin
+    """
+    rng  = random.default_rng(seed)
+    tree = cKDTree(pos)
+    npos = len(pos)
+
+    if lmin is None:
+        sample = rng.integers(0, npos, size=min(npos, 10000))
+        dnn, _ = tree.query(pos[sample], k=2)
+        lmin   = 2 * median(dnn[:,1])
+    if lmax is None:
+        lmax = 0.5 * (pos.max(axis=0) - pos.min(axis=0)).max()
+
+    edges = linspace(log(lmin), log(lmax), nbins+1)
+    sf    = zeros((len(orders), nbins+2))
+    n     = zeros(nbins+2)
+
+    for start in range(0, npairs, chunk):
+        size = min(chunk, npairs - start)
+        i    = rng.integers(0, npos, size=size)
+        dirs = rng.normal(size=(size, 3))
+        dirs/= norm(dirs, axis=1)[:,newaxis]
+        l    = exp(rng.uniform(edges[0], edges[-1], size=size))
+
+        _, j = tree.query(pos[i] + l[:,newaxis] * dirs)
+        keep = i != j
+        i, j = i[keep], j[keep]
+
+        sep  = norm(pos[j].astype(float64) - pos[i], axis=1)
+        dv   = norm(vel[j].astype(float64) - vel[i], axis=1)
+        b    = digitize(log(sep), edges)
+
+        n += bincount(b, minlength=nbins+2)
+        for o, p in enumerate(orders):
+            sf[o] += bincount(b, weights=dv**p, minlength=nbins+2)
+
+    # drop pairs outside [lmin, lmax]
+    n  = n[1:-1]
+    sf = sf[:,1:-1] / n
+    l  = exp(0.5 * (edges[1:] + edges[:-1]))
+
+    return l, sf, n
+
+
+def virial_parameters(pos, vel, mass, epot):
+    """ Function for measuring the ratios alpha and beta of kinetic and
+        rotational (around z) energies to the magnitude of gravitational
+        energy, in the center of mass frame. Always in double precision.
+    """
+    pos  = pos.astype(float64)
+    vel  = vel.astype(float64)
+    mass = mass.astype(float64)
+    mtot = mass.sum()
+
+    pos  = pos - (pos * mass[:,newaxis]).sum(axis=0) / mtot
+    vel  = vel - (vel * mass[:,newaxis]).sum(axis=0) / mtot
+    ekin = 0.5 * (mass * (vel**2).sum(axis=1)).sum()
+
+    Lz   = (mass * (pos[:,0]*vel[:,1] - pos[:,1]*vel[:,0])).sum()
+    Iz   = (mass * (pos[:,0]**2 + pos[:,1]**2)).sum()
+    erot = 0.5 * Lz**2 / Iz
+
+    return ekin / epot, erot / epot
+
+
+def report(vg, pos, vel, mass, epot, npairs=10**6):
+    """ Function for printing the diagnostics of a turbulent cloud: the
+        power index and solenoidality of the velocity grid, the second
+        order structure function at the particles, and the achieved
+        alpha and beta.
+    """
+    start = time()
+    print("\nDiagnostics of the turbulent velocity field")
+
+    k, pk, ratio = spectral_sums(vg)
+    npow = spectral_index(k, pk)
+    print("  power index of the grid  : {:.3f}".format(npow) +
+          ("" if not hasattr(vg, "npow") else
+           " (requested {:g})".format(vg.npow)))
+    print("  |div v|^2 / |curl v|^2   : {:.3e}".format(ratio))
+
+    l, sf, n = structure_functions(pos, vel, orders=(2,), npairs=npairs)
+    good = (n > 0) & isfinite(sf[0]) & (sf[0] > 0)
+    if good.sum() > 1:
+        slope, _ = polyfit(log(l[good]), log(sf[0,good]), 1)
+        print("  S_2(l) slope at particles: {:.3f}".format(slope) +
+              ("" if not hasattr(vg, "npow") else
+               " (-npow-3 = {:g})".format(-vg.npow-3)))
+
+    alpha, beta = virial_parameters(pos, vel, mass, epot)
+    print("  alpha                    : {:.6f}".format(alpha))
+    print("  beta                     : {:.6f}".format(beta))
+
+    print("Diagnostics took {:g}s.\n".format(time()-start))
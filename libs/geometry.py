@@ -0,0 +1,184 @@
+from __future__ import print_function
+
+from numpy import pi, prod, array, full, mgrid, where, concatenate
+from numpy import float64, maximum, random
+from numpy.linalg import norm
+from scipy.special import elliprf
+
+from libs.const import G
+
+
+def close_packed(n, half, volume, inside):
+    """ Function for filling a body with a close-packed (fcc) lattice.
+        The lattice fills the bounding box [-half, half] with a cell
+        size such that about n points end inside the body.
+
+        Arguments:
+            n     : total number of desired points
+            half  : half size of the bounding box along each axis
+            volume: volume of the body
+            inside: function returning True for points (centered at the
+                    origin) inside the body
+
+        Returns:
+            pos   : positions of the points inside the body
+            dx    : min particle separation
+    """
+    half  = array(half, dtype=float64)
+    cell  = (4. * volume / n)**(1./3)
+    nside = maximum((2*half / cell).astype(int), 1)
+    naux  = prod(nside)
+
+    z3    = mgrid[0:nside[0], 0:nside[1], 0:nside[2]].reshape(3, naux).T
+    grid  = (concatenate((z3, z3+[0.5, 0.5, 0], z3+[0, 0.5, 0.5],
+             z3+[0.5, 0, 0.5])) + 0.25) * cell
+
+    pos   = grid - 0.5 * nside * cell
+    pos   = pos[where(inside(pos))[0]]
+
+    return pos, 0.5 * cell
+
+
+def pair_energy(pos, mass, npairs=10**6, seed=0):
+    """ Function for estimating the magnitude of gravitational energy of
+        a set of particles, 0.5 G sum_ij m_i m_j / r_ij, from randomly
+        sampled pairs.
+    """
+    rng   = random.default_rng(seed)
+    npart = len(pos)
+    i     = rng.integers(0, npart, size=npairs)
+    j     = rng.integers(0, npart, size=npairs)
+    keep  = i != j
+    i, j  = i[keep], j[keep]
+
+    r     = norm(pos[i].astype(float64) - pos[j], axis=1)
+    mm    = mass[i].astype(float64) * mass[j]
+
+    return 0.5 * G * npart * (npart - 1.) * (mm / r).mean()
+
+
+class Ellipsoid:
+    """ Class for creating a distribution of particles in a close-packed
+        homogeneous ellipsoid.
+
+        Arguments:
+            n     : total number of desired points to represent the body
+            center: coordinates of the ellipsoid's center (with units)
+            axes  : semi-axes along x, y and z (with units)
+            mass  : ellipsoid's mass (with units)
+            dtype : floating point type of positions and masses
+    """
+    def __init__(self, n=10000, center=[0.,0.,0.], axes=[1.,1.,1.], mass=1.,
+                 dtype=float64):
+
+        axes   = array(axes, dtype=float64)
+        center = array(center)
+        volume = 4./3 * pi * prod(axes)
+
+        inside = lambda p: norm(p / axes, axis=1) <= 1
+        pos, h = close_packed(n, axes, volume, inside)
+
+        npart  = len(pos)
+        pos    = (pos + center).astype(dtype)
+        masses = full(npart, mass / float(npart), dtype=dtype)
+        print("We placed {:d} gas cells in a close-packed ellipsoid.".\
+               format(npart))
+
+        self.npart  = npart
+        self.dx     = h
+        self.pos    = pos
+        self.axes   = axes
+        self.extent = axes
+        self.center = center
+        self.mass   = masses
+
+    def potential_energy(self):
+        # exact for a homogeneous ellipsoid, 3/5 G M^2 R_F(a^2, b^2, c^2)
+        a2 = self.axes**2
+        return 3./5. * G * self.mass.sum(dtype=float64)**2 * \
+               elliprf(a2[0], a2[1], a2[2])
+
+
+class Cylinder:
+    """ Class for creating a distribution of particles in a close-packed
+        cylinder (filament) along the z axis.
+
+        Arguments:
+            n     : total number of desired points to represent the body
+            center: coordinates of the cylinder's center (with units)
+            radius: cylinder's radius (with units)
+            length: cylinder's length (with units)
+            mass  : cylinder's mass (with units)
+            dtype : floating point type of positions and masses
+    """
+    def __init__(self, n=10000, center=[0.,0.,0.], radius=1., length=4.,
+                 mass=1., dtype=float64):
+
+        center = array(center)
+        half   = array([radius, radius, 0.5*length])
+        volume = pi * radius**2 * length
+
+        inside = lambda p: (norm(p[:,:2], axis=1) <= radius) & \
+                           (abs(p[:,2]) <= 0.5*length)
+        pos, h = close_packed(n, half, volume, inside)
+
+        npart  = len(pos)
+        pos    = (pos + center).astype(dtype)
+        masses = full(npart, mass / float(npart), dtype=dtype)
+        print("We placed {:d} gas cells in a close-packed cylinder.".\
+               format(npart))
+
+        self.npart  = npart
+        self.dx     = h
+        self.pos    = pos
+        self.r      = radius
+        self.length = length
+        self.extent = half
+        self.center = center
+        self.mass   = masses
+
+    def potential_energy(self):
+        # no simple closed form, we estimate it from the particles
+        return pair_energy(self.pos, self.mass)
+
+
+class PeriodicBox:
+    """ Class for creating particles on the nodes of a cubic lattice
+        filling a periodic box. The lattice matches the nodes of a
+        periodic VelocityGrid with ngrid = nside * stride, so the
+        velocities can be read from the grid without interpolation.
+
+        Arguments:
+            n     : total number of desired points (rounded to an even
+                    number of points per side)
+            center: coordinates of the box's center (with units)
+            side  : box's side (with units)
+            mass  : box's mass (with units)
+            dtype : floating point type of positions and masses
+    """
+    def __init__(self, n=10000, center=[0.,0.,0.], side=1., mass=1.,
+                 dtype=float64):
+
+        nside  = max(2 * int(round(0.5 * n**(1./3))), 2)
+        npart  = nside**3
+        center = array(center)
+        h      = side / float(nside)
+
+        # same ordering as the flattened velocity cubes
+        z3     = mgrid[0:nside, 0:nside, 0:nside].reshape(3, npart).T
+        pos    = (z3 * h + center - 0.5*side).astype(dtype)
+        masses = full(npart, mass / float(npart), dtype=dtype)
+        print("We placed {:d}^3 gas cells in a periodic box.".format(nside))
+
+        self.npart  = npart
+        self.nside  = nside
+        self.dx     = h
+        self.pos    = pos
+        self.side   = side
+        self.extent = full(3, 0.5*side)
+        self.center = center
+        self.mass   = masses
+
+    def potential_energy(self):
+        # we use the energy of an isolated homogeneous cube as reference
+        return 0.9411563 * G * self.mass.sum(dtype=float64)**2 / self.side
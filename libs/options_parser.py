@@ -9,8 +9,8 @@ class OptionsParser:
         self.parser.add_argument("-N", "-n",
                             dest     = "num",
                             type     = int,
-                            help     = "Number of particles (required).",
-                            required = True)
+                            help     = "Number of particles (required unless\n"+\
+                                       "an input file is given).")
 
         self.parser.add_argument("-o",
                             metavar = "outfile",
@@ -19,6 +19,24 @@ class OptionsParser:
                                       " [Default = ics_cloud.dat]",
                             default = "ics_cloud.dat")
 
+        self.parser.add_argument("-i",
+                            metavar = "infile",
+                            dest    = "infile",
+                            help    = "Existing Gadget (format 1/2) or HDF5 file.\n"+\
+                                      "Its gas velocities are replaced by the\n"+\
+                                      "turbulent field (and rotation) and written\n"+\
+                                      "to the output file, in the same format\n"+\
+                                      "and units (see --units).",
+                            default = None)
+
+        self.parser.add_argument("-chunk",
+                            dest     = "chunk",
+                            type     = int,
+                            help     = "Number of particles processed at a time\n"+\
+                                       "when reading an input file.\n"+\
+                                       " [Default = 1048576]",
+                            default  = 2**20)
+
         self.parser.add_argument("-format",
                             dest    = "format",
                             type    = int,
@@ -51,6 +69,24 @@ class OptionsParser:
                                        " [Default = 256]",
                             default  = 256)
 
+        self.parser.add_argument("-levels",
+                            dest     = "levels",
+                            type     = int,
+                            help     = "Number of refined velocity grids nested\n"+\
+                                       "around the center, for concentrated\n"+\
+                                       "profiles. Each has ngrid points per\n"+\
+                                       "dimension and carries the smaller scales.\n"+\
+                                       " [Default = 0]",
+                            default  = 0)
+
+        self.parser.add_argument("-refine",
+                            dest     = "refine",
+                            type     = float,
+                            help     = "Size ratio between consecutive nested\n"+\
+                                       "grids.\n"+\
+                                       " [Default = 2]",
+                            default  = 2.)
+
         self.parser.add_argument("-r", "-radius",
                             dest     = "radius",
                             type     = float,
@@ -82,11 +118,86 @@ class OptionsParser:
                                        " [Default = 0 (Uniform)]",
                             default  = 0)
 
+        self.parser.add_argument("-geometry",
+                            dest     = "geometry",
+                            choices  = ["sphere", "ellipsoid", "cylinder", "box"],
+                            help     = "Shape of the cloud. The radius sets the\n"+\
+                                       "scale of the ellipsoid axes, the radius\n"+\
+                                       "of the cylinder (along z) and half the\n"+\
+                                       "side of the periodic box.\n"+\
+                                       " [Default = sphere]",
+                            default  = "sphere")
+
+        self.parser.add_argument("-axes",
+                            dest     = "axes",
+                            type     = float,
+                            nargs    = 3,
+                            help     = "Semi-axes of the ellipsoid along x, y, z\n"+\
+                                       "in units of the radius.\n"+\
+                                       " [Default = 1 1 1]",
+                            default  = [1., 1., 1.])
+
+        self.parser.add_argument("-length",
+                            dest     = "length",
+                            type     = float,
+                            help     = "Length of the cylinder (in parsecs).\n"+\
+                                       " [Default = 4]",
+                            default  = 4.)
+
+        self.parser.add_argument("-tile",
+                            dest     = "tile",
+                            type     = int,
+                            help     = "Number of times the (periodic) velocity\n"+\
+                                       "grid is repeated along the cloud.\n"+\
+                                       " [Default = 1]",
+                            default  = 1)
+
+        self.parser.add_argument("-sink",
+                            dest     = "sink",
+                            type     = float,
+                            help     = "Mass of a sink particle (type 5) placed\n"+\
+                                       "at the center (in solar masses). It is\n"+\
+                                       "not included in the virial normalisation.\n"+\
+                                       " [Default = 0 (No sink)]",
+                            default  = 0.)
+
         self.parser.add_argument("--units",
                             dest     = "units",
                             help     = "Change units to Msol/Parsec/km s^{-1} ",
                             action   = "store_true")
 
+        self.parser.add_argument("--single",
+                            dest     = "single",
+                            help     = "Use single precision (float32/complex64)\n"+\
+                                       "for grids, positions and velocities.\n"+\
+                                       "Energies are still computed in double.",
+                            action   = "store_true")
+
+        self.parser.add_argument("--longids",
+                            dest     = "longids",
+                            help     = "Write 64-bit particle IDs (needed by\n"+\
+                                       "codes compiled with LONGIDS). They are\n"+\
+                                       "used anyway if IDs exceed 2^31.",
+                            action   = "store_true")
+
+        self.parser.add_argument("--diagnostics",
+                            dest     = "diagnostics",
+                            help     = "Print the power index, divergence and\n"+\
+                                       "structure function of the velocity\n"+\
+                                       "field and the achieved alpha/beta.",
+                            action   = "store_true")
+
     def get_args(self):
-        return self.parser.parse_args()
+        args = self.parser.parse_args()
+        if args.num is None and args.infile is None:
+            self.parser.error("the number of particles (-n) is required.")
+        if args.tile < 1:
+            self.parser.error("the number of tiles (-tile) must be at least 1.")
+        if args.levels < 0:
+            self.parser.error("the number of levels (-levels) can not be negative.")
+        if args.refine <= 1:
+            self.parser.error("the refinement ratio (-refine) must be above 1.")
+        if args.chunk < 1:
+            self.parser.error("the chunk size (-chunk) must be at least 1.")
+        return args
 
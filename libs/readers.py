@@ -0,0 +1,213 @@
+from __future__ import print_function
+
+from sys import exit
+from struct import unpack
+from numpy import frombuffer, memmap, broadcast_to, array
+from numpy import uint32, uint64, int32, float32, float64
+from h5py import File, is_hdf5
+
+from libs.utils import NTYPES
+
+
+def open_snapshot(infile, mode='r'):
+    """ Function for opening a Gadget (format 1 or 2) or HDF5 snapshot.
+        Use mode='r+' to modify it in place.
+    """
+    if is_hdf5(infile):
+        return HDF5Snapshot(infile, mode)
+    return GadgetSnapshot(infile, mode)
+
+
+class GadgetSnapshot:
+    """ Class for reading Gadget binary snapshots (format 1 or 2). The
+        blocks are memory-mapped, so particles are only read when they
+        are accessed, and written back if opened with mode='r+'.
+        Format 1 blocks are identified by their order (POS, VEL, ID,
+        MASS if any type has individual masses, and U if there is gas).
+
+        Arguments:
+            infile: name of the snapshot
+            mode  : 'r' for reading, 'r+' for reading and writing
+    """
+    def __init__(self, infile, mode='r'):
+
+        self.infile = infile
+        self.mode   = mode
+        self.maps   = []
+
+        with open(infile, 'rb') as f:
+            nbytes = unpack('i', f.read(4))[0]
+            if nbytes == 8:
+                self.format = 2
+            elif nbytes == 256:
+                self.format = 1
+            else:
+                print("File {} is not a Gadget snapshot. Exiting.".\
+                       format(infile))
+                exit()
+
+            # the header comes after the label record in format 2
+            f.seek(4 if self.format == 1 else 20)
+            header = f.read(256)
+
+            nlow   = frombuffer(header[0:24], dtype=uint32).astype(uint64)
+            nhigh  = frombuffer(header[168:192], dtype=uint32).astype(uint64)
+
+            self.npart     = nlow + (nhigh << uint64(32))
+            self.masstable = frombuffer(header[24:72], dtype=float64).copy()
+            self.time      = frombuffer(header[72:80], dtype=float64)[0]
+
+            f.seek(0)
+            self.blocks = self._scan(f)
+
+
+    def _scan(self, f):
+        # walk through the records, keeping the offset and size of each.
+        # Markers only hold sizes modulo 2^32, so the sizes of the known
+        # blocks are computed from the number of elements, with 4 or 8
+        # bytes each (whichever agrees with the marker)
+        order  = [b'HEAD', b'POS ', b'VEL ', b'ID  ', b'MASS', b'U   ']
+        ntot   = int(self.npart.sum())
+        nvar   = int(self.npart[(self.npart > 0) & (self.masstable == 0)].sum())
+        counts = {b'POS ': 3*ntot, b'VEL ': 3*ntot, b'ID  ': ntot,
+                  b'MASS': nvar, b'U   ': int(self.npart[0])}
+
+        if self.format == 1 and nvar == 0:
+            # without labels, the header tells if there is a MASS block
+            order.remove(b'MASS')
+
+        blocks = {}
+        nblock = 0
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4:
+                break
+
+            if self.format == 2:
+                name   = f.read(4)
+                f.seek(8, 1)
+                marker = f.read(4)
+            elif nblock < len(order):
+                name   = order[nblock]
+            else:
+                name   = "BLOCK{:d}".format(nblock).encode()
+
+            nbytes = unpack('I', marker)[0]
+            if name in counts:
+                for size in (4, 8):
+                    if (size * counts[name]) % 2**32 == nbytes:
+                        nbytes = size * counts[name]
+                        break
+
+            blocks[name] = (f.tell(), nbytes)
+            f.seek(nbytes + 4, 1)
+            nblock += 1
+
+        return blocks
+
+
+    def _map(self, name, ptypes, ptype, ncols, kind):
+        # memory map the part of block name that belongs to ptype,
+        # given the types (ptypes) stored in the block
+        if name not in self.blocks:
+            print("Block {} not found in {}. Exiting.".\
+                   format(name.decode(), self.infile))
+            exit()
+
+        offset, nbytes = self.blocks[name]
+        ntot   = int(sum(self.npart[t] for t in ptypes))
+        size   = nbytes // (ntot * ncols)
+        dtype  = {('f', 4): float32, ('f', 8): float64,
+                  ('i', 4): int32,   ('i', 8): uint64}[(kind, size)]
+        start  = int(sum(self.npart[t] for t in ptypes if t < ptype))
+        shape  = (int(self.npart[ptype]), ncols) if ncols > 1 else\
+                 (int(self.npart[ptype]),)
+
+        data   = memmap(self.infile, dtype=dtype, mode=self.mode,
+                        offset=offset + start*ncols*size, shape=shape)
+        self.maps.append(data)
+
+        return data
+
+
+    def _types(self):
+        return [t for t in range(NTYPES) if self.npart[t] > 0]
+
+
+    def positions(self, ptype=0):
+        return self._map(b'POS ', self._types(), ptype, 3, 'f')
+
+    def velocities(self, ptype=0):
+        return self._map(b'VEL ', self._types(), ptype, 3, 'f')
+
+    def ids(self, ptype=0):
+        return self._map(b'ID  ', self._types(), ptype, 1, 'i')
+
+    def masses(self, ptype=0):
+        if self.masstable[ptype] > 0:
+            return broadcast_to(self.masstable[ptype], (int(self.npart[ptype]),))
+        varmass = [t for t in self._types() if self.masstable[t] == 0]
+        return self._map(b'MASS', varmass, ptype, 1, 'f')
+
+    def energies(self):
+        return self._map(b'U   ', [0], 0, 1, 'f')
+
+    def close(self):
+        # write back the changes of every memory map handed out
+        for data in self.maps:
+            data.flush()
+        self.maps = []
+
+
+class HDF5Snapshot:
+    """ Class for reading HDF5 snapshots. Datasets are returned without
+        reading them, so particles are read (and written back if opened
+        with mode='r+') only when sliced.
+
+        Arguments:
+            infile: name of the snapshot
+            mode  : 'r' for reading, 'r+' for reading and writing
+    """
+    def __init__(self, infile, mode='r'):
+
+        self.infile = infile
+        self.file   = File(infile, mode)
+
+        header = self.file["Header"].attrs
+        npart  = header["NumPart_ThisFile"].astype(uint64)
+        if "NumPart_Total_HighWord" in header:
+            npart += header["NumPart_Total_HighWord"].astype(uint64) << uint64(32)
+
+        self.npart     = npart
+        self.masstable = array(header["MassTable"], dtype=float64)
+        self.time      = header["Time"]
+
+
+    def _dataset(self, name, ptype):
+        group = "PartType{:d}".format(ptype)
+        if name not in self.file.get(group, {}):
+            print("Dataset {}/{} not found in {}. Exiting.".\
+                   format(group, name, self.infile))
+            exit()
+        return self.file[group][name]
+
+
+    def positions(self, ptype=0):
+        return self._dataset("Coordinates", ptype)
+
+    def velocities(self, ptype=0):
+        return self._dataset("Velocities", ptype)
+
+    def ids(self, ptype=0):
+        return self._dataset("ParticleIDs", ptype)
+
+    def masses(self, ptype=0):
+        if self.masstable[ptype] > 0:
+            return broadcast_to(self.masstable[ptype], (int(self.npart[ptype]),))
+        return self._dataset("Masses", ptype)
+
+    def energies(self):
+        return self._dataset("InternalEnergy", 0)
+
+    def close(self):
+        self.file.close()
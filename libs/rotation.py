@@ -1,7 +1,7 @@
 from __future__ import print_function
 
-from numpy import sum, mean, sqrt, cross
-from numpy import array, isnan, newaxis
+from numpy import sum, sqrt, cross
+from numpy import array, isnan, newaxis, float64, asarray, zeros
 from numpy.linalg import norm
 import warnings
 warnings.filterwarnings('ignore')
@@ -11,6 +11,8 @@ class Rotation:
         Some modes/noise may appear when setting a LARGE beta value.
         This method efficiency scales as ~ alpha/(alpha+beta), so we
         rescale beta if necessary.
+        Energies are always accumulated in double precision, and the
+        velocities are returned with the same type they were given.
 
         Arguments:
            beta : ratio of rotational energy to the magnitude of
@@ -33,43 +35,70 @@ class Rotation:
                    format(beta))
             self.erot = epot*alpha*beta/float(alpha-beta)
 
-    def add_rotation(self, pos, vel, mass):
+    def add_rotation(self, pos, vel, mass, chunk=None):
+        """ Function for adding rotation around the z axis. Velocities
+            are updated in place. If chunk is given, particles are
+            processed in chunks of that size, so pos, vel and mass can
+            also be memory-mapped arrays or HDF5 datasets.
+        """
 
         if self.erot is None: return vel # nothing to do here
 
+        # mass * r**2 overflows single precision in cgs
+        npart  = len(mass)
+        chunk  = npart if chunk is None else chunk
+        chunks = [slice(i, i+chunk) for i in range(0, npart, chunk)]
+        get    = lambda a, s: asarray(a[s], dtype=float64)
+
         # operate from center of mass
-        pos     = pos - sum(pos * mass[:,newaxis], axis=0)/sum(mass)
-        ekin_o  = sum(mass * norm(vel, axis=1)**2)
+        mtot    = 0.
+        mpos    = zeros(3)
+        ekin_o  = 0.
+        for s in chunks:
+            m       = get(mass, s)
+            mtot   += sum(m)
+            mpos   += sum(get(pos, s) * m[:,newaxis], axis=0)
+            ekin_o += sum(m * norm(get(vel, s), axis=1)**2)
+        com     = mpos / mtot
 
         # we set rotational energy according to beta
         # first we calculate the desired angular velocity
-        Iz      = sum(mass * (pos[:,0]**2 + pos[:,1]**2))
+        # and measure the existing mean angular velocity
+        Iz      = 0.
+        omegaux = zeros(3)
+        for s in chunks:
+            p        = get(pos, s) - com
+            o        = cross(p, get(vel, s))
+            Iz      += sum(get(mass, s) * (p[:,0]**2 + p[:,1]**2))
+            omegaux += [sum(o[:,0] / norm(p[:,[1,2]], axis=1)**2),
+                        sum(o[:,1] / norm(p[:,[2,0]], axis=1)**2),
+                        sum(o[:,2] / norm(p[:,[0,1]], axis=1)**2)]
         omega_d = sqrt(2*self.erot/Iz)
-
-        # now we measure the existing mean angular velocity
-        omegaux = cross(pos, vel)
-
-        omegax  = mean(omegaux[:,0] / norm(pos[:,[1,2]], axis=1)**2)
-        omegay  = mean(omegaux[:,1] / norm(pos[:,[2,0]], axis=1)**2)
-        omegaz  = mean(omegaux[:,2] / norm(pos[:,[0,1]], axis=1)**2)
-
-        omega_e = array([omegax, omegay, omegaz])
+        omega_e = omegaux / npart
 
         # we add the new and subtract the old angular velocity
-        vel += cross(array([0,0,omega_d]) - omega_e, pos)
+        domega  = array([0,0,omega_d]) - omega_e
+        ekin_n  = 0.
+        for s in chunks:
+            v       = get(vel, s) + cross(domega, get(pos, s) - com)
+            ekin_n += sum(get(mass, s) * norm(v, axis=1)**2)
+            vel[s]  = v
 
         # we re-normalize the velocities to preserve alpha relation
         # to do so, we measure the ratio ekin_old/ekin_new and
         # distribute it over all particles
-        vel2  = norm(vel, axis=1)**2
-        ratio = ekin_o / sum(mass * vel2)
+        ratio = ekin_o / ekin_n
 
         # in order not to affect omega, re-escale only vz if possible,
         # else the whole vector
-        factor       = sqrt((ratio * vel2 - vel[:,0]**2 - vel[:,1]**2)\
-                            / vel[:,2]**2)
-        nan          = isnan(factor)
-        vel[~nan,2] *= factor[~nan]       # possible
-        vel[nan]    *= sqrt(ratio)        # not possible
+        for s in chunks:
+            v          = get(vel, s)
+            vel2       = norm(v, axis=1)**2
+            factor     = sqrt((ratio * vel2 - v[:,0]**2 - v[:,1]**2)\
+                              / v[:,2]**2)
+            nan        = isnan(factor)
+            v[~nan,2] *= factor[~nan]       # possible
+            v[nan]    *= sqrt(ratio)        # not possible
+            vel[s]     = v
 
         return vel
@@ -1,10 +1,12 @@
 from __future__ import print_function
 
 from sys import exit
-from numpy import meshgrid, sqrt, log, exp, zeros, linspace, array, cross
-from numpy import fft, random
-from numpy import pi
+from numpy import meshgrid, sqrt, log, exp, linspace, array, arange
+from numpy import fft, random, result_type, floor, empty, stack, int64
+from numpy import asarray, where, abs, zeros, full, cos, clip, minimum
+from numpy import pi, float64, complex64
 from time import time
+from scipy.fft import irfftn
 from scipy.interpolate import RegularGridInterpolator
 
 class VelocityGrid:
@@ -15,15 +17,24 @@ class VelocityGrid:
         transformed back to real space.
         Based on Dubinski et al. (1995).
 
+        Wavenumbers are measured in units of kmin, which only changes the
+        (arbitrary) amplitude of the field but keeps the spectrum within
+        single precision range.
+
         Arguments:
            npow : power index of spectrum.
            ngrid: number of grid points per dimension (must be even).
            xmax : outer scale of turbulence.
            dx   : physical separation between neighboring points.
            seed : number that determines the random realization.
+           dtype: floating point type of the real space cubes (float64 or
+                  float32). Spectra use the matching complex type.
+           kfilter: modes with all |k_i| <= kfilter (in units of kmin) are
+                  left out, e.g. because a coarser grid already has them.
     """
 
-    def __init__(self, npow=-4., ngrid=256, xmax=1., dx=0.01, seed=27021987):
+    def __init__(self, npow=-4., ngrid=256, xmax=1., dx=0.01, seed=27021987,
+                 dtype=float64, kfilter=0.):
 
         start = time()
         print("Creating 3-D velocity grid with power spectrum P_k~k**{}".\
@@ -32,66 +43,101 @@ class VelocityGrid:
         if ngrid % 2 != 0:
             print("Grid points must be an even number. Exiting.")
             exit()
-        nc = int(ngrid/2) + 1
+
+        cdtype = result_type(dtype, complex64)
 
         kmax = 2*pi/dx
         kmin = 2*pi/xmax
 
-        kx = fft.fftfreq(ngrid, d=1/(2*kmax))
+        kx = (fft.fftfreq(ngrid, d=1/(2*kmax)) / kmin).astype(dtype)
         ky = kx
-        kz = fft.rfftfreq(ngrid, d=1/(2*kmax))
+        kz = (fft.rfftfreq(ngrid, d=1/(2*kmax)) / kmin).astype(dtype)
 
         # we produce a 3-D grid of the Fourier coordinates
         kxx, kyy, kzz = meshgrid(kx, ky, kz, indexing='ij', sparse=True)
-        kk = kxx*kxx + kyy*kyy + kzz*kzz + kmin**2
+        kk = kxx*kxx + kyy*kyy + kzz*kzz + 1
+        kp = kk**((npow-2.)/4.)
+        del kk
+
+        if kfilter > 0:
+            low = (abs(kxx) <= kfilter) & (abs(kyy) <= kfilter) & \
+                  (abs(kzz) <= kfilter)
+            kp  = where(low, 0, kp).astype(dtype, copy=False)
+            del low
 
         random.seed(seed)
 
         # we sample the components of a vector potential, as we want
         # an incompresible velocity field
-        xi1 = random.random(size=kk.shape)
-        xi2 = random.random(size=kk.shape)
-        c   = kk**((npow-2.)/4.)*sqrt(-log(1-xi1))
-        phi = 2*pi*xi2
-        akx = c*exp(1j*phi)
-        xi1 = random.random(size=kk.shape)
-        xi2 = random.random(size=kk.shape)
-        c   = kk**((npow-2.)/4.)*sqrt(-log(1-xi1))
-        phi = 2*pi*xi2
-        aky = c*exp(1j*phi)
-        xi1 = random.random(size=kk.shape)
-        xi2 = random.random(size=kk.shape)
-        c   = kk**((npow-2.)/4.)*sqrt(-log(1-xi1))
-        phi = 2*pi*xi2
-        akz = c*exp(1j*phi)
-
-        new_shape = akx.shape+(3,)
-        kv = zeros(new_shape, dtype=akx.dtype)
-        kv[:,:,:,0] = 1j*kxx
-        kv[:,:,:,1] = 1j*kyy
-        kv[:,:,:,2] = 1j*kzz
-        ak = zeros(new_shape, dtype=akx.dtype)
-        ak[:,:,:,0] = akx
-        ak[:,:,:,1] = aky
-        ak[:,:,:,2] = akz
+        akx = self._sample_component(kp, cdtype)
+        aky = self._sample_component(kp, cdtype)
+        akz = self._sample_component(kp, cdtype)
+        del kp
 
         # the velocity vector in Fourier space is obtained by
-        # taking the curl of A, which is
-        vk = cross(kv, ak)
-
+        # taking the curl of A, i.e. v_k = i k x A_k
         self.ngrid = ngrid
-        self.vx    = fft.irfftn(vk[:,:,:,0])
-        self.vy    = fft.irfftn(vk[:,:,:,1])
-        self.vz    = fft.irfftn(vk[:,:,:,2])
+        self.npow  = npow
+        self.xmax  = xmax
+        self.dx    = dx
+        self.seed  = seed
+        self.dtype = dtype
+        self.vx    = irfftn(1j*(kyy*akz - kzz*aky)).astype(dtype, copy=False)
+        self.vy    = irfftn(1j*(kzz*akx - kxx*akz)).astype(dtype, copy=False)
+        self.vz    = irfftn(1j*(kxx*aky - kyy*akx)).astype(dtype, copy=False)
 
         print("\nInverse Fourier Transform took {:g}s.".format(time()-start))
 
 
-    def coordinate_grid(self, xstart=0., xend=1.):
-        self.x = linspace(xstart, xend, self.ngrid)
-
-
-    def add_turbulence(self, pos, vel):
+    @staticmethod
+    def _sample_component(kp, cdtype):
+        # random numbers are always drawn in double precision, so that
+        # both precisions share the same realization for a given seed
+        xi1 = random.random(size=kp.shape)
+        xi2 = random.random(size=kp.shape)
+        ak  = kp * sqrt(-log(1-xi1)).astype(kp.dtype)
+        del xi1
+        return ak * exp(2j*pi*xi2).astype(cdtype)
+
+
+    def coordinate_grid(self, xstart=0., xend=1., periodic=False):
+        """ Function for placing the grid in space. If periodic, the
+            field repeats with period xend-xstart (xend is identified
+            with xstart), and positions outside the grid are wrapped, so
+            one realization can be tiled over any region.
+        """
+        if periodic:
+            h      = (xend - xstart) / float(self.ngrid)
+            self.x = (xstart + h * arange(self.ngrid)).astype(self.dtype)
+        else:
+            self.x = linspace(xstart, xend, self.ngrid).astype(self.dtype)
+
+        # period of the field, one spacing more than the grid if it
+        # is not periodic
+        self.periodic = periodic
+        self.period   = (xend - xstart) * (1. if periodic else
+                                           self.ngrid / (self.ngrid - 1.))
+
+
+    def node_velocities(self, stride=1):
+        """ Function for reading the velocities at every stride-th node
+            of the grid, flattened in C order (x slowest), without
+            interpolation.
+        """
+        s = slice(None, None, stride)
+        return stack((self.vx[s,s,s].ravel(), self.vy[s,s,s].ravel(),
+                      self.vz[s,s,s].ravel()), axis=1)
+
+
+    def add_turbulence(self, pos, vel, chunk=None):
+
+        if chunk is not None:
+            # pos and vel may be memory-mapped arrays or HDF5 datasets,
+            # vel is updated in place one chunk at a time
+            for i in range(0, len(pos), chunk):
+                s      = slice(i, i+chunk)
+                vel[s] = self.add_turbulence(pos[s], vel[s])
+            return vel
 
         pos = array(pos).reshape(-1,3)
         vel = array(vel).reshape(-1,3)
@@ -101,6 +147,10 @@ class VelocityGrid:
             print("         Please make sure this is what you want.")
             self.coordinate_grid()
 
+        if self.periodic:
+            vel += self._interpolate_periodic(pos)
+            return vel
+
         x  = self.x
         vx = self.vx
         vy = self.vy
@@ -120,8 +170,181 @@ class VelocityGrid:
         return vel
 
 
+    def _interpolate_periodic(self, pos, chunk=2**20):
+        # trilinear interpolation with indices wrapped around the grid,
+        # done in chunks of particles over the flattened cubes
+        n     = self.ngrid
+        h     = self.period / float(n)
+        cubes = (self.vx.ravel(), self.vy.ravel(), self.vz.ravel())
+        vel   = empty(pos.shape, dtype=self.dtype)
+
+        for start in range(0, len(pos), chunk):
+            u  = (pos[start:start+chunk].astype(float64) - self.x[0]) / h
+            i0 = floor(u).astype(int64)
+            f  = u - i0
+            i0 %= n
+            i1 = (i0 + 1) % n
+
+            v = 0.
+            for cx in (0, 1):
+                ix = i1[:,0] if cx else i0[:,0]
+                wx = f[:,0] if cx else 1 - f[:,0]
+                for cy in (0, 1):
+                    iy = i1[:,1] if cy else i0[:,1]
+                    wy = f[:,1] if cy else 1 - f[:,1]
+                    for cz in (0, 1):
+                        iz = i1[:,2] if cz else i0[:,2]
+                        wz = f[:,2] if cz else 1 - f[:,2]
+                        idx = (ix*n + iy)*n + iz
+                        w   = (wx * wy * wz)[:,None]
+                        v   = v + w * stack([c[idx] for c in cubes], axis=1)
+
+            vel[start:start+chunk] = v
+
+        return vel
+
+
+class NestedGrid:
+    """ Class for a coarse VelocityGrid with refined sub-cubes nested
+        around dense regions. Each level only samples the modes that its
+        parent (the previous level, or the coarse grid) cannot resolve,
+        with the same outer scale and power spectrum normalisation, so
+        all levels are parts of one spectral realization. A particle gets
+        the coarse velocity plus the increments of every level covering
+        it, i.e. the field of the finest grid at its position. Increments
+        are tapered to zero at the faces of each sub-cube.
+
+        Arguments:
+           coarse: VelocityGrid already placed with coordinate_grid.
+    """
+
+    def __init__(self, coarse):
+
+        if not hasattr(coarse, 'x'):
+            print("WARNING: Nesting on a grid with default coordinates.")
+            print("         Please make sure this is what you want.")
+            coarse.coordinate_grid()
+
+        self.coarse = coarse
+        self.levels = []
+
+
+    def add_level(self, center, side, ngrid=None, seed=None, taper=0.1):
+        """ Function for adding a refined cube inside the previous level.
+
+            Arguments:
+                center: coordinates of the cube's center
+                side  : physical side of the cube
+                ngrid : grid points per dimension (default as the coarse)
+                seed  : random realization of the new small scale modes
+                taper : fraction of the side over which the increment
+                        goes to zero at the faces
+        """
+        coarse = self.coarse
+        ngrid  = coarse.ngrid if ngrid is None else ngrid
+        seed   = coarse.seed + len(self.levels) + 1 if seed is None else seed
+        center = array(center, dtype=float64)
+
+        if len(self.levels) > 0:
+            pgrid, pcorner, pside, _ = self.levels[-1]
+        else:
+            pgrid, pcorner, pside = coarse, full(3, coarse.x[0]), \
+                                    coarse.x[-1] - coarse.x[0]
+
+        corner = center - 0.5*side
+        if (corner < pcorner).any() or (corner + side > pcorner + pside).any():
+            print("Refined grids must be nested in the previous one. Exiting.")
+            exit()
+
+        # k is measured in units of the outer scale of the coarse grid,
+        # and the modes of a grid of side L are spaced as kunit / L
+        ratio   = coarse.period / side
+        kunit   = 2. * coarse.xmax / (coarse.dx * coarse.ngrid)
+        kfilter = 0.5 * pgrid.ngrid * kunit * coarse.period / pgrid.period
+        dx      = coarse.dx * coarse.ngrid / (ngrid * ratio)
+
+        print("Refining a {:g} times smaller region.".format(ratio))
+        grid = VelocityGrid(npow=coarse.npow, ngrid=ngrid, xmax=coarse.xmax,
+                            dx=dx, seed=seed, dtype=coarse.dtype,
+                            kfilter=kfilter)
+        grid.coordinate_grid(xstart=0., xend=side, periodic=True)
+
+        # same power per physical mode in a smaller volume
+        amp      = (ngrid / float(coarse.ngrid))**3 * ratio**1.5
+        grid.vx *= amp
+        grid.vy *= amp
+        grid.vz *= amp
+
+        self.levels.append((grid, corner, side, taper))
+
+
+    def add_turbulence(self, pos, vel, chunk=None):
+
+        if chunk is not None:
+            for i in range(0, len(pos), chunk):
+                s      = slice(i, i+chunk)
+                vel[s] = self.add_turbulence(pos[s], vel[s])
+            return vel
+
+        pos = array(pos).reshape(-1,3)
+        vel = self.coarse.add_turbulence(pos, vel)
+
+        for grid, corner, side, taper in self.levels:
+            local  = pos - corner
+            inside = ((local >= 0) & (local <= side)).all(axis=1)
+            if not inside.any():
+                continue
+
+            local = local[inside]
+            dv    = grid.add_turbulence(local, zeros(local.shape, grid.dtype))
+
+            if taper > 0:
+                d  = clip(minimum(local, side - local) / (taper*side), 0, 1)
+                w  = (0.5 - 0.5*cos(pi*d)).prod(axis=1)
+                dv = dv * w[:,None]
+
+            vel[inside] += dv
+
+        return vel
+
+
+def normalize_turbulence(vel, mass, alpha, epot, chunk=None):
+    """ Function for rescaling a turbulent velocity field such that its
+        kinetic energy is alpha times the gravitational energy.
+        Energies are accumulated in double precision, while the
+        velocities keep their own type.
+
+        Arguments:
+            vel  : particles velocities (modified in place)
+            mass : particles masses
+            alpha: ratio of turbulent energy to the magnitude of
+                   gravitational energy.
+            epot : magnitude of gravitational energy.
+            chunk: if given, particles are processed in chunks of this
+                   size (for memory-mapped arrays or HDF5 datasets).
+    """
+    if chunk is None:
+        vtur = vel - vel.mean(axis=0, dtype=float64)
+        etur = 0.5 * (mass.astype(float64) * (vtur**2).sum(axis=1)).sum()
+        vel *= sqrt(alpha * epot / etur)
+        return vel
 
+    npart  = len(mass)
+    chunks = [slice(i, i+chunk) for i in range(0, npart, chunk)]
 
+    vmean = 0.
+    for s in chunks:
+        vmean += asarray(vel[s], dtype=float64).sum(axis=0)
+    vmean /= npart
 
+    etur = 0.
+    for s in chunks:
+        vtur  = asarray(vel[s], dtype=float64) - vmean
+        etur += 0.5 * (asarray(mass[s], dtype=float64) *
+                       (vtur**2).sum(axis=1)).sum()
 
+    kvel = sqrt(alpha * epot / etur)
+    for s in chunks:
+        vel[s] = vel[s] * kvel
 
+    return vel
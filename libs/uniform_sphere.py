@@ -4,7 +4,7 @@ from numpy import pi, sum, max, min, log, exp
 from numpy import diff, where, unique, argsort
 from numpy import array, full, linspace, mgrid
 from numpy import transpose, append, digitize
-from numpy import concatenate
+from numpy import concatenate, float64
 from numpy.linalg import norm
 
 class Sphere:
@@ -16,8 +16,10 @@ class Sphere:
             center: coordinates of the sphere's center (with units)
             radius: sphere's radius (with units)
             mass  : sphere's mass   (with units)
+            dtype : floating point type of positions and masses
     """
-    def __init__(self, n=10000, center=[0.,0.,0.], radius=1., mass=1.):
+    def __init__(self, n=10000, center=[0.,0.,0.], radius=1., mass=1.,
+                 dtype=float64):
 
         # first we create a cube with uniform distribution, hence we need to sample
         # more particles than the desired N
@@ -39,7 +41,8 @@ class Sphere:
         ig     = where(r <= radius)[0]
         pos    = pos[ig] + center
         npart  = len(ig)
-        masses = full(npart, mass / float(npart)) # uniform masses
+        pos    = pos.astype(dtype)
+        masses = full(npart, mass / float(npart), dtype=dtype) # uniform masses
         print("We placed {:d} gas cells in a close-packed sphere.".format(npart))
 
         self.npart  = npart
@@ -75,8 +78,10 @@ class Sphere:
             print("Setting radial density profile with "+\
                         "RHO~r**{}".format(gamma))
 
-            # we use centered transpose of pos
-            pos  = transpose(self.pos - self.center)
+            # we use centered transpose of pos, in double precision as
+            # r**(gamma+3) easily overflows single precision in cgs
+            dtype = self.pos.dtype
+            pos   = transpose(self.pos - self.center).astype(float64)
 
             if method == 1:
 
@@ -92,7 +97,7 @@ class Sphere:
                 # new min separation
                 dx = min(diff(unique(pos[0])))
 
-                self.pos  = transpose(pos) + self.center
+                self.pos  = (transpose(pos) + self.center).astype(dtype)
                 self.dx   = dx
 
 
@@ -132,5 +137,5 @@ class Sphere:
                 # distribute mass
                 masses  = PM_b[Pb_ind]
 
-                self.pos  = transpose(pos) + self.center
-                self.mass = masses
+                self.pos  = (transpose(pos) + self.center).astype(dtype)
+                self.mass = masses.astype(dtype)
@@ -2,37 +2,77 @@ from __future__ import print_function
 
 from sys import exc_info, exit
 from os import path, remove
-from numpy import array, zeros, uint32, int, int32, float32
+from numpy import array, zeros, uint32, uint64, int32, float32
+from numpy import ascontiguousarray
 from logging import warning
 from struct import pack
 from h5py import File
 
 from libs.const import msol, parsec
 
-def save_particles(ids, pos, vel, mass, u, outfile, format, units):
+NTYPES = 6
+
+def save_particles(ids, pos, vel, mass, u, outfile, format, units,
+                   components=None, long_ids=None):
+    """ Function for writing the initial conditions to a file.
+        The gas (type 0) is given by the positional arguments, while
+        other Gadget particle types (e.g. a dark matter halo or sink
+        particles) can be passed in components.
+        Types with uniform masses are stored in the MassTable of the
+        header and skipped from the MASS block.
+
+        Arguments:
+            ids, pos, vel, mass, u: gas particles properties
+            outfile   : name of the output file
+            format    : 0 = ASCII, 1 = Gadget 1, 2 = Gadget 2, 3 = HDF5
+            units     : convert to Parsec/Msun/km s^-1
+            components: dict of {ptype: (ids, pos, vel, mass)} for
+                        ptype in 1..5
+            long_ids  : write 64-bit IDs. If None, they are used only
+                        when IDs do not fit in 32 bits.
+    """
+
+    ngas  = len(mass)
+    parts = {0: (ids, pos, vel, mass)}
+    if components is not None:
+        for ptype in components:
+            if ptype < 1 or ptype >= NTYPES:
+                print("Particle type {} is not valid. Exiting.".format(ptype))
+                exit()
+        parts.update(components)
+    ptypes = sorted(parts)
+
+    npart = zeros(NTYPES, dtype=uint64)
+    for ptype in ptypes:
+        npart[ptype] = len(parts[ptype][3])
 
-    ngas = len(mass)
     # conversion for different Units
     if units:
         print("[Output Units Parsec / Msun / km/s]")
-        pos  /= parsec
-        mass /= msol
-        vel  /= 1.e5
+        for ptype in ptypes:
+            _, p, v, m = parts[ptype]
+            p /= parsec
+            m /= msol
+            v /= 1.e5
         u    /= 1.e10
     else:
         print("[Output Units CGS]")
 
-    if path.isfile(outfile):
-        print("WARNING: File {} already exist.".format(outfile))
-        print("Do yo want to overwrite it? Y/[N]")
-        q = input()
-        if q.lower() in ['y', 'yes', 's', 'si']:
-            remove(outfile)
-        else:
-            print('Exiting.')
-            exit()
+    masstable = mass_table(parts)
+
+    if long_ids is None:
+        long_ids = max(parts[t][0].max() for t in ptypes if npart[t] > 0)\
+                   >= 2**31
+        if long_ids:
+            print("IDs do not fit in 32 bits, writing 64-bit IDs.")
+    id_type = uint64 if long_ids else int32
+
+    check_outfile(outfile)
 
     if format == 0:
+        if len(ptypes) > 1:
+            print("WARNING: ASCII format only stores gas particles.")
+
         # Openning file
         try:
             ofile = open(outfile,'w')
@@ -75,172 +115,143 @@ def save_particles(ids, pos, vel, mass, u, outfile, format, units):
         # Closing the file
         ofile.close()
 
-    elif format == 1:
-        npart = array([ngas, 0, 0, 0, 0, 0])
-        Nmass = array([0, 0, 0, 0, 0, 0])
-        # Linearizing the 3D-array of the position and velocity
-        pos = pos.ravel()
-        vel = vel.ravel()
-
-        dummy = zeros(npart[0])
-        time = 0.            # double
-        redshift = 0.0       # double
-        flag_sfr = 0         # int
-        flag_feedback = 0    # int
-        bytesleft = 256 - 6*4 - 6*8 - 8 - 8 - 2*4 - 6*4
-        fill = zeros(int(bytesleft/4.0), dtype=int)  # int
-
+    elif format in [1, 2]:
+        # Gadget records, with a labelled header per block in format 2
         with open(outfile, 'wb') as f:
-            nbytes = 256
-            # Header
-            f.write(pack('i', nbytes))
-            f.write(pack('i' * len(npart), *npart))
-            f.write(pack('d' * len(Nmass), *Nmass))
-            f.write(pack('d', time))
-            f.write(pack('d', redshift))
-            f.write(pack('i', flag_sfr))
-            f.write(pack('i', flag_feedback))
-            f.write(pack('i' * len(npart), *npart))
-            f.write(pack('i' * len(fill), *fill))
-            f.write(pack('i', nbytes))
-
-            # Positions
-            nbytes = int(len(pos) * 4)
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(pos), *pos))
-            f.write(pack('i', nbytes))
-
-            # Velocities
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(vel), *vel))
-            f.write(pack('i', nbytes))
-
-            # Ids
-            nbytes = int(len(ids) * 4)
-            f.write(pack('i', nbytes))
-            f.write(pack('i' * len(ids), *ids))
-            f.write(pack('i', nbytes))
-
-            # Masses
-            nbytes = len(mass) * 4
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(mass), *mass))
-            f.write(pack('i', nbytes))
-
-            # Energy
-            nbytes = len(u) * 4
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(u), *u))
-            f.write(pack('i', nbytes))
-
-    elif format == 2:
-        npart = array([ngas, 0, 0, 0, 0, 0])
-        Nmass = array([0, 0, 0, 0, 0, 0])
-        # Linearizing the 3D-array of the position and velocity
-        pos = pos.ravel()
-        vel = vel.ravel()
-
-        dummy = zeros(npart[0])
-        time = 0.            # double
-        redshift = 0.0       # double
-        flag_sfr = 0         # int
-        flag_feedback = 0    # int
-        bytesleft = 256 - 6*4 - 6*8 - 8 - 8 - 2*4 - 6*4
-        fill = zeros(int(bytesleft/4.0), dtype=int)  # int
+            write_block(f, b'HEAD', [gadget_header(npart, masstable)],
+                        None, format)
 
+            write_block(f, b'POS ', [parts[t][1] for t in ptypes],
+                        float32, format)
+            write_block(f, b'VEL ', [parts[t][2] for t in ptypes],
+                        float32, format)
+            write_block(f, b'ID  ', [parts[t][0] for t in ptypes],
+                        id_type, format)
 
-        with open(outfile, 'wb') as f:
+            # only types with individual masses go into the MASS block
+            varmass = [parts[t][3] for t in ptypes if masstable[t] == 0]
+            if len(varmass) > 0:
+                write_block(f, b'MASS', varmass, float32, format)
 
-            nbytes  = 256
-            nbytes4 = 8
-
-            f.write(pack('i', nbytes4))
-            f.write(b'HEAD')
-            f.write(pack('i', nbytes + 8))
-            f.write(pack('i', nbytes4))
-            # Header
-
-            f.write(pack('i', nbytes))
-            f.write(pack('i' * len(npart), *npart))
-            f.write(pack('d' * len(Nmass), *Nmass))
-            f.write(pack('d', time))
-            f.write(pack('d', redshift))
-            f.write(pack('i', flag_sfr))
-            f.write(pack('i', flag_feedback))
-            f.write(pack('i' * len(npart), *npart))
-            f.write(pack('i' * len(fill), *fill))
-            f.write(pack('i', nbytes))
-
-            # Positions
-            nbytes = int(len(pos) * 4)
-            f.write(pack('i', nbytes4))
-            f.write(b'POS ')
-            f.write(pack('i', nbytes + 8))
-            f.write(pack('i', nbytes4))
-
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(pos), *pos))
-            f.write(pack('i', nbytes))
-
-            # Velocities
-            f.write(pack('i', nbytes4))
-            f.write(b'VEL ')
-            f.write(pack('i', nbytes + 8))
-            f.write(pack('i', nbytes4))
-
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(vel), *vel))
-            f.write(pack('i', nbytes))
-
-            # Ids
-            nbytes = int(len(ids) * 4)
-            f.write(pack('i', nbytes4))
-            f.write(b'ID  ')
-            f.write(pack('i', nbytes + 8))
-            f.write(pack('i', nbytes4))
-
-            f.write(pack('i', nbytes))
-            f.write(pack('i' * len(ids), *ids))
-            f.write(pack('i', nbytes))
-
-            # Masses
-            nbytes = int(len(mass) * 4)
-            f.write(pack('i', nbytes4))
-            f.write(b'MASS')
-            f.write(pack('i', nbytes+8))
-            f.write(pack('i', nbytes4))
-
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(mass), *mass))
-            f.write(pack('i', nbytes))
-
-            # Energy
-            nbytes = int(len(u) * 4)
-            f.write(pack('i', nbytes4))
-            f.write(b'U   ')
-            f.write(pack('i', nbytes + 8))
-            f.write(pack('i', nbytes4))
-
-            f.write(pack('i', nbytes))
-            f.write(pack('f' * len(u), *u))
-            f.write(pack('i', nbytes))
+            write_block(f, b'U   ', [u], float32, format)
 
     elif format == 3:
         with File(outfile, "w") as f:
             f.create_group("Header")
-            f.create_group("PartType0")
-            f["Header"].attrs["NumPart_ThisFile"] = array([ngas,0,0,0,0,0], dtype=uint32)
-            f["Header"].attrs["MassTable"]        = [0.,0.,0.,0.,0.,0.]
-            f["Header"].attrs["Time"]             = 0.0
-            f["Header"].attrs["Redshift"]         = 0.0
-            f["Header"].attrs["Flag_Sfr"]         = int32(0)
-            f["Header"].attrs["Flag_Feedback"]    = int32(0)
-            f["PartType0"].create_dataset("Masses",         data=mass.astype(float32))
-            f["PartType0"].create_dataset("Coordinates",    data=pos.astype(float32))
-            f["PartType0"].create_dataset("Velocities",     data=vel.astype(float32))
-            f["PartType0"].create_dataset("ParticleIDs",    data=ids.astype(int32))
+            f["Header"].attrs["NumPart_ThisFile"]       = (npart % 2**32).astype(uint32)
+            f["Header"].attrs["NumPart_Total"]          = (npart % 2**32).astype(uint32)
+            f["Header"].attrs["NumPart_Total_HighWord"] = (npart >> 32).astype(uint32)
+            f["Header"].attrs["MassTable"]              = masstable
+            f["Header"].attrs["Time"]                   = 0.0
+            f["Header"].attrs["Redshift"]               = 0.0
+            f["Header"].attrs["Flag_Sfr"]               = int32(0)
+            f["Header"].attrs["Flag_Feedback"]          = int32(0)
+            for ptype in ptypes:
+                pids, p, v, m = parts[ptype]
+                g = f.create_group("PartType{:d}".format(ptype))
+                if masstable[ptype] == 0:
+                    g.create_dataset("Masses",  data=m.astype(float32))
+                g.create_dataset("Coordinates", data=p.astype(float32))
+                g.create_dataset("Velocities",  data=v.astype(float32))
+                g.create_dataset("ParticleIDs", data=pids.astype(id_type))
             f["PartType0"].create_dataset("InternalEnergy", data=u.astype(float32))
 
     else:
         print("Format {} unknown or not implemented. Exiting.".format(format))
         exit()
+
+
+def check_outfile(outfile):
+    """ Function for asking before overwriting an existing file. """
+    if path.isfile(outfile):
+        print("WARNING: File {} already exist.".format(outfile))
+        print("Do yo want to overwrite it? Y/[N]")
+        q = input()
+        if q.lower() in ['y', 'yes', 's', 'si']:
+            remove(outfile)
+        else:
+            print('Exiting.')
+            exit()
+
+
+def mass_table(parts):
+    """ Function for building the Gadget MassTable. Types whose particles
+        all have the same mass get that mass in the table (so the MASS
+        block can skip them), the rest get zero.
+
+        Arguments:
+            parts: dict of {ptype: (ids, pos, vel, mass)}
+    """
+    masstable = zeros(NTYPES)
+    for ptype in parts:
+        m = parts[ptype][3]
+        if len(m) > 0 and (m == m[0]).all():
+            masstable[ptype] = m[0]
+
+    return masstable
+
+
+def gadget_header(npart, masstable):
+    """ Function for packing the 256 bytes of a Gadget header. Particle
+        numbers above 2^32 are split into the high word fields.
+
+        Arguments:
+            npart    : number of particles of each type
+            masstable: mass of each type (0 for individual masses)
+    """
+    npart   = array(npart, dtype=uint64)
+    nlow    = (npart % 2**32).astype(uint32)
+    nhigh   = (npart >> 32).astype(uint32)
+
+    time          = 0.     # double
+    redshift      = 0.0    # double
+    flag_sfr      = 0      # int
+    flag_feedback = 0      # int
+
+    header  = pack('I' * NTYPES, *nlow)
+    header += pack('d' * NTYPES, *masstable)
+    header += pack('d', time)
+    header += pack('d', redshift)
+    header += pack('i', flag_sfr)
+    header += pack('i', flag_feedback)
+    header += pack('I' * NTYPES, *nlow)
+    # flag_cooling, num_files, box size, cosmology and flags, all zero
+    header += bytes(4 + 4 + 4*8 + 4 + 4)
+    header += pack('I' * NTYPES, *nhigh)
+    header += bytes(256 - len(header))
+
+    return header
+
+
+def write_block(f, name, arrays, dtype, format):
+    """ Function for writing a Gadget record made of several arrays (one
+        per particle type), without concatenating them in memory.
+
+        Arguments:
+            f     : file opened in binary mode
+            name  : 4 character label of the block (format 2 only)
+            arrays: list of arrays, or bytes if dtype is None
+            dtype : type in which the arrays are stored
+            format: Gadget format (1 or 2)
+
+        Record markers are unsigned 32-bit integers, so for blocks of
+        2^32 bytes or more they only hold the size modulo 2^32 (as in
+        Gadget), and readers must get the size from the particle numbers.
+    """
+    if dtype is None:
+        nbytes = sum(len(a) for a in arrays)
+    else:
+        nbytes = sum(a.size for a in arrays) * dtype(0).itemsize
+
+    if format == 2:
+        nbytes4 = 8
+        f.write(pack('i', nbytes4))
+        f.write(name)
+        f.write(pack('I', (nbytes + 8) % 2**32))
+        f.write(pack('i', nbytes4))
+
+    f.write(pack('I', nbytes % 2**32))
+    for a in arrays:
+        # arrays are converted one at a time
+        f.write(a if dtype is None else ascontiguousarray(a, dtype=dtype))
+    f.write(pack('I', nbytes % 2**32))
@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+import numpy as np
+from libs.turbulence import VelocityGrid, normalize_turbulence
+from libs.uniform_sphere import Sphere
+from libs.rotation import Rotation
+from libs.const import G, msol, parsec
+from libs.options_parser import OptionsParser
+from libs.diagnostics import spectral_sums, virial_parameters
+
+# Runs the same realization in double and single precision and reports
+# how much the power spectrum of the grid and the alpha/beta energies of
+# the particles differ. Accepts the same arguments as cloud.py.
+
+
+def realization(args, dtype):
+
+    mcloud = args.mass * msol
+    rcloud = args.radius * parsec
+
+    cloud = Sphere(n=args.num, radius=rcloud, mass=mcloud, dtype=dtype)
+    cloud.add_profile(gamma=args.gamma)
+    pos   = cloud.pos
+    mass  = cloud.mass
+    vel   = np.zeros((cloud.npart, 3), dtype=dtype)
+
+    vg = VelocityGrid(xmax=2*rcloud, dx=cloud.dx, npow=args.npow,
+                      ngrid=args.ngrid, dtype=dtype)
+    vg.coordinate_grid(xstart=-rcloud, xend=rcloud)
+    vel = vg.add_turbulence(pos=pos, vel=vel)
+
+    epot = 3./5. * G * np.sum(mass, dtype=np.float64)**2 / rcloud
+    vel  = normalize_turbulence(vel, mass, alpha=args.alpha, epot=epot)
+
+    rot = Rotation(beta=args.beta, alpha=args.alpha, epot=epot)
+    vel = rot.add_rotation(pos=pos, vel=vel, mass=mass)
+
+    return vg, pos, vel, mass, epot
+
+
+def lattice_order(pos):
+    # sorting radii may order equidistant particles differently in each
+    # precision, so we match particles by their (rounded) positions
+    key = np.rint(pos / (1e-5 * np.abs(pos).max())).astype(np.int64)
+    return np.lexsort(key.T)
+
+
+if __name__ == "__main__":
+
+    op   = OptionsParser()
+    args = op.get_args()
+
+    vg64, pos64, vel64, mass64, epot64 = realization(args, np.float64)
+    vg32, pos32, vel32, mass32, epot32 = realization(args, np.float32)
+
+    k64, pk64, div64 = spectral_sums(vg64)
+    k32, pk32, div32 = spectral_sums(vg32)
+    good = k64 > 0   # the k=0 mode is zero by construction
+    dpk  = np.abs(pk32[good] / pk64[good] - 1)
+
+    cube = max(np.abs(c32 - c64).max() / np.abs(c64).max() for c32, c64 in
+               zip((vg32.vx, vg32.vy, vg32.vz), (vg64.vx, vg64.vy, vg64.vz)))
+    i64  = lattice_order(pos64)
+    i32  = lattice_order(pos32)
+    dvel = np.abs(vel32[i32] - vel64[i64]).max() / np.abs(vel64).max()
+
+    a64, b64 = virial_parameters(pos64, vel64, mass64, epot64)
+    a32, b32 = virial_parameters(pos32, vel32, mass32, epot32)
+
+    print("\nSingle vs double precision report")
+    print("  grid memory      : {:.1f} MB vs {:.1f} MB".format(
+           3*vg32.vx.nbytes/2.**20, 3*vg64.vx.nbytes/2.**20))
+    print("  P(k) shells      : {:d}".format(good.sum()))
+    print("  max |dP/P|       : {:.3e}".format(dpk.max()))
+    print("  mean |dP/P|      : {:.3e}".format(dpk.mean()))
+    print("  div/curl         : {:.3e} vs {:.3e}".format(div32, div64))
+    print("  max |dv|/|v| grid: {:.3e}".format(cube))
+    print("  max |dv|/|v| part: {:.3e}".format(dvel))
+    print("  alpha            : {:.8f} vs {:.8f} (rel. diff {:.3e})".format(
+           a32, a64, abs(a32/a64 - 1)))
+    print("  beta             : {:.8f} vs {:.8f} (rel. diff {:.3e})".format(
+           b32, b64, abs(b32/b64 - 1) if b64 > 0 else 0.))